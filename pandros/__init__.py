@@ -24,16 +24,38 @@
 
 from __future__ import print_function, unicode_literals
 
+import numpy as np
 import pandas as pd
+import os
 import re
+import shutil
+import tempfile
 
 import defusedxml
 from defusedxml.common import EntitiesForbidden
 
+# Content patterns, compiled once and shared by all column interpretations.
+_PNR_RE = re.compile(r'(((19|20)\d\d|\d\d)[01]\d[0-3]\d *((-|) *[T\d][\dF]\d\d|))')
+_EMAIL_RE = re.compile(r'([\w\.]+@\w[\w\.]*\w\w)', flags=re.U)
+# Letters, whitespace and hyphens only.
+_NAME_CONTENT_RE = re.compile(r'(?:[^\W\d_]|\s|-)*')
+# Suffix added by shift_header() to repeated header names.
+_DUPLICATE_SUFFIX_RE = re.compile(r'\.\d+$')
+
+def _as_string(column):
+    # Avoid copying columns that already have the "string" dtype. Other
+    # string dtypes (the NaN based "str" in pandas 3) are still cast, so
+    # missing values are always pd.NA.
+    if isinstance(column.dtype, pd.StringDtype) and getattr(column.dtype, "na_value", pd.NA) is pd.NA:
+        return column
+    return column.astype("string")
+
 def defuse():
     defusedxml.defuse_stdlib()
 
 class ValidationException(Exception):
+    _long_message = None
+
     def readable(self, indent=0):
         if self.__cause__:
             if isinstance(self.__cause__, ValidationException):
@@ -46,7 +68,9 @@ class ValidationException(Exception):
 
     @property
     def long_message(self):
-        return "\n".join(self.readable())
+        if self._long_message is None:
+            self._long_message = "\n".join(self.readable())
+        return self._long_message
 
     def __eq__(self, other):
         return self.long_message == other.long_message
@@ -60,8 +84,7 @@ class ValidationException(Exception):
 class MultiValidationException(ValidationException):
     def __init__(self, multi, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.multi = list(set(multi))
-        self.multi.sort()
+        self.multi = sorted(set(multi))
 
     def readable(self, indent=0):
         yield "   "*indent + f"{str(self)}:"
@@ -83,10 +106,13 @@ class AddResults:
         self.result_collector.set_results(self.person.index, **self.results_to_add)
 
 class ResultCollector:
-    def __init__(self, sheet, fileupdater):
+    def __init__(self, sheet, fileupdater, path=None, verbose=False):
         self.sheet = sheet
-        self.results = self.sheet
+        self.results = self.sheet.copy()
         self.fileupdater = fileupdater
+        self.path = path
+        self.verbose = verbose
+        self.dirty = False
 
     def get_value(self, row, key):
         if key not in self.results.keys():
@@ -97,18 +123,25 @@ class ResultCollector:
         return value
 
     def set_results(self, row, **new_results):
-        for key in new_results.keys():
+        for (key,value) in new_results.items():
             if key not in self.results.keys():
-                self.results = self.results.assign(**{key:""})
-            col = self.results[key].copy()
-            col[row] = new_results[key]
-            self.results = self.results.assign(**{key:col})
-        self.fileupdater.write_callback(self.results)
-        print(self.results)
+                self.results[key] = pd.Series("", index=self.results.index, dtype=object)
+            self.results.at[row, key] = value
+        self.dirty = True
+        if self.verbose:
+            print(self.results.loc[[row]])
+
+    def flush(self):
+        # Results are only kept in memory by set_results, call this when done.
+        if self.dirty:
+            self.fileupdater.write_callback(self.results)
+            self.fileupdater.flush(self.path)
+            self.dirty = False
 
 class FileAnalysis:
     def __init__(self, path):
-        interpretations = [ValidOr(SheetReadAnalysis, path, header_row_shift=header) for header in range(4)]
+        orig_sheet = read_file(path, header=None)
+        interpretations = [ValidOr(SheetReadAnalysis, path, orig_sheet, header_row_shift=header) for header in range(4)]
         valid_interpretations = [interpretation for interpretation in interpretations if interpretation.res]
 
         if len(valid_interpretations) == 0:
@@ -124,21 +157,20 @@ class FileAnalysis:
 
         self.fileupdater = interpretation.fileupdater
 
-    def get_writer(self, path):
-        return ResultCollector(self.sheet, self.fileupdater)
+    def get_writer(self, path, verbose=False):
+        return ResultCollector(self.sheet, self.fileupdater, path=path, verbose=verbose)
 
     def print(self):
         self.interpretation.print()
 
 class SheetReadAnalysis:
-    def __init__(self, path, header_row_shift=0):
-        sheet = read_file(path, header=header_row_shift)
+    def __init__(self, path, orig_sheet, header_row_shift=0):
         try:
+            sheet = shift_header(orig_sheet, header_row_shift)
             interpretation = Analysis(sheet)
         except ValidationException as e:
             raise ValidationException(f"Read with header shifted {header_row_shift} rows down failed") from e
 
-        orig_sheet = read_file(path, header=None)
         self.fileupdater = SheetUpdater(path, orig_sheet, startrow=header_row_shift)
 
         self.sheet = interpretation.sheet
@@ -147,14 +179,47 @@ class SheetReadAnalysis:
 
 class SheetUpdater:
     def __init__(self, path, orig_sheet, **update_kwargs):
-        def write_callback(new_sheet):
-            writer = pd.ExcelWriter(path)
-            # Write orig_sheet exactly as inputed
-            orig_sheet.to_excel(writer, header=None, index=False)
-            # Write new_sheet at the location where we read it before.
-            new_sheet.to_excel(writer, index=False, **update_kwargs)
-            writer.save()
-        self.write_callback = write_callback
+        self.path = path
+        self.orig_sheet = orig_sheet
+        self.update_kwargs = update_kwargs
+        self.new_sheet = None
+        self.dirty = False
+
+    def write_callback(self, new_sheet):
+        # Only remembered here, the file is written by flush().
+        self.new_sheet = new_sheet
+        self.dirty = True
+
+    def flush(self, path=None):
+        if not self.dirty:
+            return
+        if path is None:
+            path = self.path
+        # Replace the file a symlink points to, not the symlink itself.
+        path = os.path.realpath(path)
+        # Write next to the target and rename, so a failed write never
+        # leaves a half written file behind.
+        (fd, tmp_path) = tempfile.mkstemp(suffix=os.path.splitext(path)[1], dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            # mkstemp creates the file as 0600, give it the mode the
+            # target has, or would get when created normally.
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0o666 & ~umask)
+            with pd.ExcelWriter(tmp_path) as writer:
+                # Write orig_sheet exactly as inputed
+                self.orig_sheet.to_excel(writer, header=None, index=False)
+                # Write new_sheet at the location where we read it before.
+                self.new_sheet.to_excel(writer, index=False, **self.update_kwargs)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.dirty = False
 
 class Analysis:
     def __init__(self, sheet):
@@ -198,40 +263,43 @@ class PersonList:
             raise ValidationException("mismatched columns")
             return
 
-        def renamed_column(key):
-            if 'column' in self.columns[key]:
-                column = self.columns[key]['column'].column
-                return column
-                #return column.rename(key)
-            return None
-        rows = pd.concat([column for column in [renamed_column(key) for key in self.columns.keys()] if column is not None], axis=1)
+        rows = pd.DataFrame({key:keyinfo['column'].interpretation.found_data for (key,keyinfo) in self.columns.items() if 'column' in keyinfo})
 
-        for key in self.columns.keys():
-            if 'column' in self.columns[key]:
-                rows = rows.assign(**{key:self.columns[key]['column'].interpretation.found_data})
+        # Normalize pnrs to yymmddnnnn, or to yymmdd when the last four
+        # digits are missing or a TF placeholder.
+        pnrs = rows['pnr'].str.replace(r'[- ]', '', regex=True)
+        pnrs = pnrs.mask(pnrs.str.len() == 12, pnrs.str.slice(2))
+        pnrs = pnrs.mask((pnrs.str.len() == 10) & (pnrs.str.slice(6, 8) == "TF"), pnrs.str.slice(0, 6))
+        pnrs = pnrs.mask(pnrs.str.len() == 8, pnrs.str.slice(2))
+        rows['pnr'] = pnrs
 
         self.new_sheet = rows
 
-        valid_rows = None
+        valid_mask = None
         max_valid_rows = 0
         max_valid_column = None
         for (key,keyinfo) in keys.items():
             if keyinfo['required']:
-                column_valid_rows = set(keys[key]['column'].interpretation.valid_rows)
-                if len(column_valid_rows) > max_valid_rows:
-                    max_valid_rows = len(column_valid_rows)
+                column_valid_mask = keys[key]['column'].interpretation.valid_mask
+                column_valid_rows = np.count_nonzero(column_valid_mask)
+                if column_valid_rows > max_valid_rows:
+                    max_valid_rows = column_valid_rows
                     max_valid_column = key
-                if valid_rows is None:
-                    valid_rows = column_valid_rows
+                if valid_mask is None:
+                    valid_mask = column_valid_mask
                 else:
-                    valid_rows = valid_rows.intersection(column_valid_rows)
+                    valid_mask = valid_mask & column_valid_mask
 
+        valid_rows = np.flatnonzero(valid_mask).tolist()
         if 100 * len(valid_rows) / max_valid_rows < 80:
             raise ValidationException(f"Too many unmatched rows in {max_valid_column} column")
 
-        valid_rows = list(valid_rows)
-        valid_rows.sort()
-        persons = [Person(rows,i) for i in valid_rows]
+        # Pull each column out once, so Person only gets scalars.
+        pnrs = rows['pnr'].to_numpy()
+        given_names = rows['given_name'].to_numpy()
+        family_names = rows['family_name'].to_numpy()
+        emails = rows['email'].to_numpy() if 'email' in rows.columns else None
+        persons = [Person(i, pnrs[i], given_names[i], family_names[i], emails[i] if emails is not None else None) for i in valid_rows]
         self.persons = persons
 
         self.items_type = 'persons'
@@ -252,19 +320,12 @@ class PersonList:
             person.print()
 
 class Person:
-    def __init__(self, rows, index):
+    def __init__(self, index, pnr, given_name, family_name, email=None):
         self.index = index
-        row = rows[index:index+1]
-        self.pnr = row['pnr'].values[0].replace("-", "").replace(" ", "")
-        if len(self.pnr) == 12:
-            self.pnr = self.pnr[2:]
-        if len(self.pnr) == 10 and self.pnr[6:8] == "TF":
-            self.pnr = self.pnr[0:6]
-        if len(self.pnr) == 8:
-            self.pnr = self.pnr[2:]
-        self.given_name = row['given_name'].values[0]
-        self.family_name = row['family_name'].values[0]
-        self.email = row['email'].values[0] if 'email' in row else None
+        self.pnr = pnr
+        self.given_name = given_name
+        self.family_name = family_name
+        self.email = email
 
     def print(self):
         print(f"row {self.index}: pnr {self.pnr}, given name {self.given_name}, family name {self.family_name}, email {self.email}")
@@ -273,7 +334,20 @@ class ColumnAnalysis:
     def __init__(self, column):
         self.column = column
 
-        self.interpretation = InterpretationCandidates([FamilyNameColumn, GivenNameColumn, PnrColumn, EmailColumn]).find_one(column)
+        try:
+            name = str(column.name.strip())
+        except Exception as e:
+            raise ValidationException(f"Could not parse column name '{column.name}'") from e
+        # The header alone decides which column class to try, the classes
+        # themselves only check the content. Repeated headers match like
+        # the first one, so PersonList sees every column for a key.
+        candidates = COLUMN_HEADERS.find_all(_DUPLICATE_SUFFIX_RE.sub("", name))
+        if not candidates:
+            raise ValidationException(f"Unrecognized column name '{column.name}'")
+        if len(candidates) > 1:
+            raise ValidationException(f"Ambiguous column name '{column.name}'")
+
+        self.interpretation = candidates[0](column)
 
 class ValidOr:
     def __init__(self, f, *args, **kwargs):
@@ -302,88 +376,87 @@ class InterpretationCandidates:
 
         return valid_interpretations[0]
 
+# Finds all column classes whose NAME_RE matches a header, in one match using optional named lookaheads.
+class HeaderCandidates:
+    def __init__(self, classes):
+        self.classes = classes
+        self.header_re = re.compile("".join(f"(?:(?=(?P<{cls.KEY}>{cls.NAME_RE.pattern})))?" for cls in classes), flags=re.I)
+
+    def find_all(self, name):
+        match = self.header_re.match(name)
+        return [cls for cls in self.classes if match.group(cls.KEY) is not None]
+
 class NameColumn:
     KEY = None
     NAME_RE = None
     MIN_LENGTH = 2
 
     def __init__(self, column):
-        try:
-            name = str(column.name.strip())
-        except Exception as e:
-            raise ValidationException(f"Could not parse column name '{column.name}'") from e
-        if not self.NAME_RE.match(name):
-            raise ValidationException(f"Unrecognized column name '{column.name}'")
-
-        def istext(s):
-            if pd.isna(s):
-                return False
-            s = str(s).strip()
-            return len(s) >= self.MIN_LENGTH and all([c.isalpha() or c.isspace() or c == "-" for c in s])
+        str_column = _as_string(column)
+        stripped = str_column.str.strip()
+        text_mask = stripped.str.fullmatch(_NAME_CONTENT_RE, na=False) & (stripped.str.len() >= self.MIN_LENGTH)
 
         num_rows = len(column)
-        valid_rows = [i for i in column.index if istext(column[i])]
+        valid_mask = text_mask.to_numpy(dtype=bool)
+        valid_rows = np.flatnonzero(valid_mask)
         if 100 * len(valid_rows) / num_rows < 60:
             raise ValidationException(f"Content of column '{column.name}' is not mostly alphabetical")
 
         self.column = column
-        self.names = [str(row).strip() for row in column.convert_dtypes()]
+        self.names = stripped.tolist()
         self.found_data = self.names
         self.key = self.KEY
         self.valid_rows = valid_rows
+        self.valid_mask = valid_mask
 
 class FamilyNameColumn(NameColumn):
     KEY = "family_name"
-    NAME_RE = re.compile("((last|family).*name|efternamn)", flags=re.I)
+    NAME_RE = re.compile("^(?:(?:last|family).{0,32}names?|efternamn)$", flags=re.I)
     MIN_LENGTH = 1
 
 class GivenNameColumn(NameColumn):
     KEY = "given_name"
-    NAME_RE = re.compile("((first|given).*name|förnamn)", flags=re.I)
+    NAME_RE = re.compile("^(?:(?:first|given).{0,32}names?|förnamn)$", flags=re.I)
 
 class PnrColumn:
-    NAME_RE = re.compile("((person|p|t).*(number|nmr|nr|nummer))|(birth(day|date)|födelse(dag|datum))", flags=re.I)
+    KEY = "pnr"
+    NAME_RE = re.compile("^(?:(?:person|p|t).{0,32}(?:number|nmr|nr|nummer)|birth(?:day|date)|födelse(?:dag|datum))$", flags=re.I)
 
     def __init__(self, column):
-        try:
-            name = str(column.name.strip())
-        except Exception as e:
-            raise ValidationException(f"Could not parse column name '{column.name}'") from e
-        if not self.NAME_RE.match(name): 
-            raise ValidationException(f"Unrecognized column name '{column.name}'")
-
-        pnrs = column.astype("string").str.extract(r'(((19|20)\d\d|\d\d)[01]\d[0-3]\d *((-|) *[T\d][\dF]\d\d|))')[0]
-        valid_rows = [i for i in pnrs.index if not pd.isna(pnrs[i])]
+        str_column = _as_string(column)
+        pnrs = str_column.str.extract(_PNR_RE)[0]
+        valid_mask = pnrs.notna().to_numpy(dtype=bool)
+        valid_rows = np.flatnonzero(valid_mask)
         if 100 * len(valid_rows) / len(pnrs) < 60:
             raise ValidationException("Content does not match pnr data")
 
         self.column = column
         self.pnrs = pnrs
         self.found_data = self.pnrs
-        self.key = "pnr"
+        self.key = self.KEY
         self.valid_rows = valid_rows
+        self.valid_mask = valid_mask
 
 class EmailColumn:
-    NAME_RE = re.compile("(e*-*mail|e*-*post)(adress|address)", flags=re.I)
+    KEY = "email"
+    NAME_RE = re.compile("^e*-*(?:mail|post)(?:adress|address)$", flags=re.I)
 
     def __init__(self, column):
-        try:
-            name = str(column.name.strip())
-        except Exception as e:
-            raise ValidationException(f"Could not parse column name '{column.name}'") from e
-        if not self.NAME_RE.match(name):
-            raise ValidationException(f"Unrecognized column name '{column.name}'")
-
-        emails = column.convert_dtypes().str.extract('([\w\.]+@\w[\w\.]*\w\w)', flags=re.U)[0]
-        valid_rows = [i for i in emails.index if not pd.isna(emails[i])]
+        str_column = _as_string(column)
+        emails = str_column.str.extract(_EMAIL_RE)[0]
+        valid_mask = emails.notna().to_numpy(dtype=bool)
+        valid_rows = np.flatnonzero(valid_mask)
         if 100 * len(valid_rows) / len(emails) < 60:
             raise ValidationException("Content is not valid email addresses")
 
         self.column = column
         self.emails = emails
         self.found_data = self.emails
-        self.key = "email"
+        self.key = self.KEY
         self.valid_rows = valid_rows
+        self.valid_mask = valid_mask
+
+COLUMN_HEADERS = HeaderCandidates([FamilyNameColumn, GivenNameColumn, PnrColumn, EmailColumn])
 
 def read_file(path, *args, **kwargs):
     if path.endswith(".xlsx"):
@@ -396,6 +469,24 @@ def read_file(path, *args, **kwargs):
         return pd.read_csv(path, *args, **kwargs)
     raise Exception("Unknown input format")
 
+def shift_header(orig_sheet, header_row_shift):
+    # Same as read_file(path, header=header_row_shift), but from a sheet
+    # already read with header=None.
+    if header_row_shift >= len(orig_sheet):
+        raise ValidationException(f"No row {header_row_shift} to use as header")
+    names = []
+    for (i, value) in enumerate(orig_sheet.iloc[header_row_shift]):
+        name = f"Unnamed: {i}" if pd.isna(value) else str(value)
+        unique_name = name
+        n = 0
+        while unique_name in names:
+            n += 1
+            unique_name = f"{name}.{n}"
+        names.append(unique_name)
+    sheet = orig_sheet.iloc[header_row_shift+1:].reset_index(drop=True)
+    sheet.columns = names
+    return sheet
+
 def write_file(sheet, path, **kwargs):
     if path.endswith(".xlsx"):
         sheet.to_excel(path, **kwargs)
@@ -5,7 +5,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="pandros",
-    version="0.0.5",
+    version="0.1.0",
     author="Alexander Boström",
     author_email="abo@kth.se",
     description="Pandas based routines for interpreting account list shreadsheets",
@@ -19,6 +19,6 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.6',
-    install_requires=["pandas", "openpyxl", "xlrd", "odfpy", "defusedxml"],
+    install_requires=["numpy", "pandas", "openpyxl", "xlrd", "odfpy", "defusedxml"],
 )
 